@@ -1,53 +1,88 @@
+import asyncio
+import concurrent.futures
 import json
+import os
 import sys
 import calendar
-from collections import defaultdict, OrderedDict
+from html import escape
 from datetime import datetime
 from pathlib import Path
-import urllib.request
-import urllib.error
+import shutil
+import tempfile
 import time
 import zipfile
-import io
+
+import httpx
+
+try:
+    import ciso8601  # optional C parser for the common ISO-style dates
+except ImportError:
+    ciso8601 = None
+
+try:
+    import orjson  # optional, parses big exports several times faster
+except ImportError:
+    orjson = None
+
+# Date formats seen in Snapchat exports (after stripping " UTC")
+_DATE_FMTS = ("%Y-%m-%d %H:%M:%S", "%B %d, %Y")
+
+
+def _parse_date(date_str):
+    """Parse an export date string, or return None if no format matches."""
+    cleaned = date_str.replace(" UTC", "")
+    if ciso8601 is not None:
+        try:
+            return ciso8601.parse_datetime(cleaned)
+        except ValueError:
+            pass
+    for fmt in _DATE_FMTS:
+        try:
+            return datetime.strptime(cleaned, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _first(get, *keys):
+    """Return the first truthy value among several key spellings."""
+    for key in keys:
+        value = get(key)
+        if value:
+            return value
+    return None
 
 
 def load_memories(json_path: Path):
     """Load and normalize memories from Snapchat export JSON."""
-    with json_path.open("r", encoding="utf-8") as f:
-        data = json.load(f)
+    if orjson is not None:
+        data = orjson.loads(json_path.read_bytes())
+    else:
+        data = json.loads(json_path.read_bytes())
 
     items = data.get("Saved Media", [])
     print(f"Found {len(items)} items in 'Saved Media'")
     normalized = []
 
     for idx, item in enumerate(items):
-        date_str = item.get("Date") or item.get("date")
-        media_type = item.get("Media Type") or item.get("media_type") or ""
-        location = item.get("Location") or item.get("location") or ""
-        
-        # Get the media URL
-        media_download_url = (
-            item.get("Media Download Url")
-            or item.get("Media Download URL")
-            or item.get("media_download_url")
+        get = item.get
+        date_str = _first(get, "Date", "date")
+        media_type = _first(get, "Media Type", "media_type") or ""
+        location = _first(get, "Location", "location") or ""
+
+        # Get the media URL (direct link first, wrapper link as fallback)
+        download_link = _first(
+            get,
+            "Media Download Url", "Media Download URL", "media_download_url",
+            "Download Link", "download_link",
         )
-        wrapper_link = item.get("Download Link") or item.get("download_link")
-        download_link = media_download_url or wrapper_link
 
         if not date_str or not download_link:
             if idx < 5:
                 print(f"  Item {idx}: Skipping - no date or URL")
             continue
 
-        # Parse date
-        dt = None
-        for fmt in ["%Y-%m-%d %H:%M:%S %Z", "%Y-%m-%d %H:%M:%S", "%B %d, %Y"]:
-            try:
-                dt = datetime.strptime(date_str.replace(" UTC", ""), fmt.replace(" %Z", ""))
-                break
-            except ValueError:
-                pass
-        
+        dt = _parse_date(date_str)
         if not dt:
             if idx < 5:
                 print(f"  Item {idx}: Skipping - couldn't parse date: '{date_str}'")
@@ -57,6 +92,8 @@ def load_memories(json_path: Path):
             "datetime": dt,
             "date_str": date_str,
             "media_type": media_type,
+            # Classified once here so render loops don't re-lower the string
+            "is_video": "video" in media_type.lower(),
             "location": location,
             "url": download_link,
         })
@@ -64,169 +101,294 @@ def load_memories(json_path: Path):
     return normalized
 
 
+# How many downloads to keep in flight at once
+CONCURRENCY = 16
+
+# Extra attempts per file after a failed transfer (resumed via Range)
+RETRIES = 2
+
+
+def _pick_extension(media_type, url):
+    """Pick a file extension from the media type, falling back to the URL."""
+    if "video" in media_type:
+        return "mp4"
+    if "image" in media_type or "photo" in media_type:
+        return "jpg"
+    # Try from URL
+    url_lower = url.lower()
+    if ".mp4" in url_lower:
+        return "mp4"
+    if ".mov" in url_lower:
+        return "mov"
+    if ".jpg" in url_lower or ".jpeg" in url_lower:
+        return "jpg"
+    if ".png" in url_lower:
+        return "png"
+    return "jpg"  # default
+
+
+def _extract_zip(spool, local_path):
+    """Extract the main media file from a spooled ZIP download.
+
+    Streams in 64 KB chunks so neither the compressed blob nor the
+    decompressed member is ever held fully in memory. Returns the number
+    of bytes written, or raises ValueError if the ZIP holds no usable
+    media.
+    """
+    spool.seek(0)
+    with zipfile.ZipFile(spool) as zf:
+        # Look for file with '-main.' in the name
+        main_file = None
+        for name in zf.namelist():
+            if '-main.' in name:
+                main_file = name
+                break
+
+        # If no -main, find any media file that's not overlay
+        if not main_file:
+            for name in zf.namelist():
+                if ('-overlay' not in name and
+                    'overlay' not in name.lower() and
+                    any(name.lower().endswith(e) for e in ['.mp4', '.mov', '.jpg', '.jpeg', '.png', '.heic'])):
+                    main_file = name
+                    break
+
+        if not main_file:
+            raise ValueError("No media file found in ZIP")
+
+        with zf.open(main_file) as src, open(local_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, length=1 << 16)
+        return local_path.stat().st_size
+
+
+async def _fetch(client, sem, extract_pool, url, entries, total, media_dir,
+                 downloaded, failed, start_time):
+    """Download one unique URL, bounded by the shared semaphore.
+
+    `entries` is every (idx, item) pair referencing this URL; they all
+    share the single downloaded file.
+    """
+    idx, item = entries[0]
+    dt = item["datetime"]
+    media_type = item["media_type"].lower()
+
+    # Create filename: YYYYMMDD_HHMMSS_index.ext
+    timestamp = dt.strftime("%Y%m%d_%H%M%S")
+    ext = _pick_extension(media_type, url)
+
+    filename = f"{timestamp}_{idx:04d}.{ext}"
+    local_path = media_dir / filename
+    relative_path = f"media/{filename}"
+
+    sink = None  # chosen once the first bytes reveal ZIP wrapper vs raw media
+    is_zip = False
+    try:
+        try:
+            async with sem:
+                for attempt in range(RETRIES + 1):
+                    try:
+                        headers = {}
+                        received = sink.tell() if sink is not None else 0
+                        if received:
+                            # Resume the broken transfer where it stopped
+                            headers['Range'] = f'bytes={received}-'
+                        async with client.stream(
+                            "GET", url, headers=headers, timeout=30.0,
+                        ) as response:
+                            if received and response.status_code != 206:
+                                # Server ignored the range; start over
+                                sink.seek(0)
+                                sink.truncate()
+                            response.raise_for_status()
+                            async for chunk in response.aiter_bytes(1 << 16):
+                                if sink is None:
+                                    # ZIP wrappers spool for extraction (big
+                                    # ones spill to a temp file); raw media
+                                    # streams straight into its final file
+                                    is_zip = chunk.startswith(b'PK\x03\x04')
+                                    if is_zip:
+                                        sink = tempfile.SpooledTemporaryFile(
+                                            max_size=8 * 1024 * 1024
+                                        )
+                                    else:
+                                        sink = open(local_path, 'wb')
+                                sink.write(chunk)
+                        break
+                    except (httpx.HTTPError, asyncio.TimeoutError):
+                        if attempt == RETRIES:
+                            raise
+
+            if is_zip:
+                # ZIP inflate + disk writes run on the extraction pool, so
+                # decompressing this file overlaps the next file's transfer
+                await asyncio.get_running_loop().run_in_executor(
+                    extract_pool, _extract_zip, sink, local_path
+                )
+            elif sink is None:
+                # Empty body; keep the (empty) file for parity with before
+                local_path.touch()
+        finally:
+            if sink is not None:
+                sink.close()
+
+        # Every entry referencing this URL points at the one local file
+        for _, entry_item in entries:
+            item_copy = entry_item.copy()
+            item_copy["local_path"] = relative_path
+            downloaded.append(item_copy)
+
+    except zipfile.BadZipFile:
+        print(f"  ✗ {filename}: Invalid ZIP file")
+        failed.extend(entry_item for _, entry_item in entries)
+    except ValueError:
+        print(f"  ✗ {filename}: No media file found in ZIP")
+        failed.extend(entry_item for _, entry_item in entries)
+    except (httpx.HTTPError, asyncio.TimeoutError) as e:
+        print(f"  ✗ {filename}: Network error: {str(e)[:40]}")
+        failed.extend(entry_item for _, entry_item in entries)
+    except Exception as e:
+        print(f"  ✗ {filename}: {str(e)[:50]}")
+        failed.extend(entry_item for _, entry_item in entries)
+
+    # One batched progress line every 20 completions instead of a flushed
+    # print per file (which serializes the concurrent tasks on stdout)
+    done = len(downloaded) + len(failed)
+    if done % 20 == 0 or done == total:
+        rate = done / (time.time() - start_time) * 60
+        print(f"  Progress: {done}/{total} ({rate:.1f} files/min)")
+
+
+async def _download_all(items, media_dir):
+    """Download every item concurrently and return (downloaded, failed)."""
+    downloaded = []
+    failed = []
+
+    # Exports can reference the same blob from several entries; fetch each
+    # unique URL once and let the duplicates share the file
+    by_url = {}
+    for idx, item in enumerate(items):
+        by_url.setdefault(item["url"], []).append((idx, item))
+    if len(by_url) < len(items):
+        print(f"  ({len(items) - len(by_url)} duplicate URLs will share downloads)")
+    sem = asyncio.Semaphore(CONCURRENCY)
+    # One multiplexed HTTP/2 connection per CDN origin carries many
+    # concurrent streams without per-stream TCP + TLS handshakes (httpx
+    # falls back to HTTP/1.1 keep-alive if an origin refuses h2)
+    limits = httpx.Limits(
+        max_connections=CONCURRENCY, max_keepalive_connections=8,
+        keepalive_expiry=30,
+    )
+    # MP4/JPEG are already compressed, so ask the CDN not to gzip them
+    headers = {
+        'User-Agent': 'Mozilla/5.0',
+        'Accept-Encoding': 'identity',
+    }
+    extract_pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(8, os.cpu_count() or 1)
+    )
+
+    start_time = time.time()
+    try:
+        async with httpx.AsyncClient(
+            http2=True, limits=limits, headers=headers, follow_redirects=True,
+        ) as client:
+            async with asyncio.TaskGroup() as tg:
+                for url, entries in by_url.items():
+                    tg.create_task(
+                        _fetch(client, sem, extract_pool, url, entries, len(items),
+                               media_dir, downloaded, failed, start_time)
+                    )
+    finally:
+        extract_pool.shutdown(wait=True)
+
+    return downloaded, failed
+
+
 def download_media_files(items, output_dir: Path):
     """Download all media files and return list with local paths."""
     media_dir = output_dir / "media"
     media_dir.mkdir(parents=True, exist_ok=True)
-    
+
     print(f"\nDownloading {len(items)} media files to {media_dir}...")
-    print("(This may take a while - Snapchat servers can be slow)\n")
-    downloaded = []
-    failed = []
+    print(f"(Fetching up to {CONCURRENCY} files at a time)\n")
     start_time = time.time()
-    
-    for idx, item in enumerate(items):
-        url = item["url"]
-        dt = item["datetime"]
-        media_type = item["media_type"].lower()
-        
-        # Create filename: YYYYMMDD_HHMMSS_index.ext
-        timestamp = dt.strftime("%Y%m%d_%H%M%S")
-        
-        # Determine extension
-        if "video" in media_type:
-            ext = "mp4"
-        elif "image" in media_type or "photo" in media_type:
-            ext = "jpg"
-        else:
-            # Try from URL
-            url_lower = url.lower()
-            if ".mp4" in url_lower:
-                ext = "mp4"
-            elif ".mov" in url_lower:
-                ext = "mov"
-            elif ".jpg" in url_lower or ".jpeg" in url_lower:
-                ext = "jpg"
-            elif ".png" in url_lower:
-                ext = "png"
-            else:
-                ext = "jpg"  # default
-        
-        filename = f"{timestamp}_{idx:04d}.{ext}"
-        local_path = media_dir / filename
-        relative_path = f"media/{filename}"
-        
-        # Download
-        try:
-            file_start = time.time()
-            print(f"  [{idx+1}/{len(items)}] {filename}...", end=" ", flush=True)
-            
-            # Add timeout to avoid hanging on slow downloads
-            req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(req, timeout=30) as response:
-                data = response.read()
-                content_type = response.headers.get('content-type', '').lower()
-            
-            # Check if it's a ZIP file
-            is_zip = (
-                'zip' in content_type or 
-                data[:4] == b'PK\x03\x04'  # ZIP magic number
-            )
-            
-            if is_zip:
-                # Extract the main media file from ZIP
-                try:
-                    with zipfile.ZipFile(io.BytesIO(data)) as zf:
-                        # Look for file with '-main.' in the name
-                        main_file = None
-                        for name in zf.namelist():
-                            if '-main.' in name:
-                                main_file = name
-                                break
-                        
-                        # If no -main, find any media file that's not overlay
-                        if not main_file:
-                            for name in zf.namelist():
-                                if ('-overlay' not in name and 
-                                    'overlay' not in name.lower() and
-                                    any(name.lower().endswith(e) for e in ['.mp4', '.mov', '.jpg', '.jpeg', '.png', '.heic'])):
-                                    main_file = name
-                                    break
-                        
-                        if main_file:
-                            # Extract and save the main file
-                            data = zf.read(main_file)
-                            local_path.write_bytes(data)
-                            file_size = len(data) / 1024 / 1024  # MB
-                            file_time = time.time() - file_start
-                            print(f"✓ (ZIP: {file_size:.1f}MB in {file_time:.1f}s)")
-                        else:
-                            print(f"✗ No media file found in ZIP")
-                            failed.append(item)
-                            continue
-                except zipfile.BadZipFile:
-                    print(f"✗ Invalid ZIP file")
-                    failed.append(item)
-                    continue
-            else:
-                # Regular file, save directly
-                local_path.write_bytes(data)
-                file_size = len(data) / 1024 / 1024  # MB
-                file_time = time.time() - file_start
-                print(f"✓ ({file_size:.1f}MB in {file_time:.1f}s)")
-            
-            # Add local path to item
-            item_copy = item.copy()
-            item_copy["local_path"] = relative_path
-            downloaded.append(item_copy)
-            
-            # Reduced rate limiting since we have timeout now
-            if (idx + 1) % 20 == 0:
-                elapsed = time.time() - start_time
-                rate = (idx + 1) / elapsed * 60
-                print(f"    Progress: {idx+1}/{len(items)} downloaded ({rate:.1f} files/min)")
-                time.sleep(0.3)
-                
-        except urllib.error.URLError as e:
-            print(f"✗ Network error: {str(e)[:40]}")
-            failed.append(item)
-        except TimeoutError:
-            print(f"✗ Timeout (>30s)")
-            failed.append(item)
-        except Exception as e:
-            print(f"✗ {str(e)[:50]}")
-            failed.append(item)
-    
+
+    downloaded, failed = asyncio.run(_download_all(items, media_dir))
+
     total_time = time.time() - start_time
     print(f"\n✓ Downloaded: {len(downloaded)} files in {total_time/60:.1f} minutes")
     if failed:
         print(f"✗ Failed: {len(failed)} files")
-    
+
     return downloaded
 
 
 def group_by_year_month(items):
-    """Group items by year and month."""
-    grouped = defaultdict(lambda: defaultdict(list))
+    """Group items by year and month (newest first).
 
-    for item in items:
+    Each month holds three parallel columns - (paths, labels, videos) -
+    which is everything the HTML pass reads, so the card loop can zip
+    over plain lists instead of doing dict lookups per field.
+    """
+    # One global sort keeps years, months, and the items inside each month
+    # in newest-first order as they are inserted - plain dicts preserve
+    # insertion order, so no per-bucket sorting or OrderedDict needed
+    ordered = {}
+    for item in sorted(items, key=lambda x: x["datetime"], reverse=True):
         dt = item["datetime"]
-        grouped[dt.year][dt.month].append(item)
-
-    # Sort years and months (newest first)
-    ordered = OrderedDict()
-    for year in sorted(grouped.keys(), reverse=True):
-        months = grouped[year]
-        ordered_months = OrderedDict()
-        for month in sorted(months.keys(), reverse=True):
-            # Sort items in month by datetime (newest first)
-            ordered_months[month] = sorted(
-                months[month], key=lambda x: x["datetime"], reverse=True
-            )
-        ordered[year] = ordered_months
+        months = ordered.setdefault(dt.year, {})
+        paths, labels, videos = months.setdefault(dt.month, ([], [], []))
+        paths.append(item["local_path"])
+        labels.append(dt.strftime("%B %d, %Y"))
+        videos.append(item["is_video"])
 
     return ordered
 
 
-def build_html(grouped):
-    """Generate simple offline HTML gallery."""
-    
-    # Calculate stats
-    total_items = sum(len(items) for year in grouped.values() for items in year.values())
+# Per-card markup, compiled once instead of re-built as f-strings in the
+# hottest loop (one card per downloaded memory). One template per media
+# kind keeps the loop body to a single .format call.
+_CARD_VIDEO = """
+              <div class='card'>
+                <div class='media-wrapper'>
+                  <div class='type-badge'>▶ Video</div>
+                  <video class='media' controls preload='metadata' src='{path}'></video>
+                </div>
+                <div class='card-footer'>{label}</div>
+              </div>
+"""
+_CARD_IMG = """
+              <div class='card'>
+                <div class='media-wrapper'>
+                  <div class='type-badge'>📷 Photo</div>
+                  <img class='media' src='{path}' alt='{label}' loading='lazy'>
+                </div>
+                <div class='card-footer'>{label}</div>
+              </div>
+"""
+
+
+def _iter_html(grouped):
+    """Yield the gallery HTML as a stream of UTF-8 chunks."""
+
+    # Calculate every count the page needs in one pass over the grouping
+    stats = {}
+    total_items = 0
+    total_months = 0
+    for year, months in grouped.items():
+        year_count = 0
+        month_stats = {}
+        for month_num, (paths, labels, videos) in months.items():
+            count = len(paths)
+            vid_count = sum(videos)
+            month_stats[month_num] = (count, vid_count, count - vid_count)
+            year_count += count
+        stats[year] = (year_count, month_stats)
+        total_items += year_count
+        total_months += len(months)
     total_years = len(grouped)
-    total_months = sum(len(months) for months in grouped.values())
     
-    html = f"""<!DOCTYPE html>
+    yield f"""<!DOCTYPE html>
 <html lang='en'>
 <head>
   <meta charset='UTF-8'>
@@ -461,27 +623,25 @@ def build_html(grouped):
     </header>
     
     <main>
-"""
-    
+""".encode("utf-8")
+
     # Build year sections
     for year, months in grouped.items():
-        year_count = sum(len(items) for items in months.values())
-        html += f"""
+        year_count, month_stats = stats[year]
+        yield f"""
       <div class='year-group'>
         <div class='year-header'>
           {year}
           <div class='year-summary'>{year_count} snap{'s' if year_count != 1 else ''} · {len(months)} month{'s' if len(months) != 1 else ''}</div>
         </div>
-"""
-        
+""".encode("utf-8")
+
         # Build month sections
-        for month_num, items in months.items():
+        for month_num, (paths, labels, videos) in months.items():
             month_name = calendar.month_name[month_num]
-            count = len(items)
-            vid_count = sum(1 for i in items if "video" in i["media_type"].lower())
-            img_count = count - vid_count
-            
-            html += f"""
+            count, vid_count, img_count = month_stats[month_num]
+
+            yield f"""
         <div class='month'>
           <div class='month-header'>
             <div>
@@ -496,42 +656,28 @@ def build_html(grouped):
           </div>
           <div class='month-content'>
             <div class='grid'>
-"""
-            
-            # Build media cards
-            for item in items:
-                local_path = item["local_path"]
-                date_label = item["datetime"].strftime("%B %d, %Y")
-                is_video = "video" in item["media_type"].lower()
-                
-                if is_video:
-                    media_html = f"<video class='media' controls preload='metadata' src='{local_path}'></video>"
-                    type_badge = "<div class='type-badge'>▶ Video</div>"
-                else:
-                    media_html = f"<img class='media' src='{local_path}' alt='{date_label}' loading='lazy'>"
-                    type_badge = "<div class='type-badge'>📷 Photo</div>"
-                
-                html += f"""
-              <div class='card'>
-                <div class='media-wrapper'>
-                  {type_badge}
-                  {media_html}
-                </div>
-                <div class='card-footer'>{date_label}</div>
-              </div>
-"""
-            
-            html += """
+""".encode("utf-8")
+
+            # Build media cards (escape anything that traces back to the
+            # export JSON before it lands in markup)
+            for path, label, vid in zip(paths, labels, videos):
+                tmpl = _CARD_VIDEO if vid else _CARD_IMG
+                yield tmpl.format(
+                    path=escape(path, quote=True),
+                    label=escape(label, quote=True),
+                ).encode("utf-8")
+
+            yield b"""
             </div>
           </div>
         </div>
 """
-        
-        html += """
+
+        yield b"""
       </div>
 """
-    
-    html += """
+
+    yield """
     </main>
   </div>
   
@@ -555,9 +701,14 @@ def build_html(grouped):
   </script>
 </body>
 </html>
-"""
-    
-    return html
+""".encode("utf-8")
+
+
+def write_html(grouped, output_path: Path):
+    """Stream the gallery to disk so the document is never held in RAM."""
+    with output_path.open("wb", buffering=1 << 20) as out:
+        for chunk in _iter_html(grouped):
+            out.write(chunk)
 
 
 def main():
@@ -593,10 +744,8 @@ def main():
     
     # Generate HTML
     print("\nGenerating HTML gallery...")
-    html = build_html(grouped)
-    
     output_path = output_dir / "memories_gallery.html"
-    output_path.write_text(html, encoding="utf-8")
+    write_html(grouped, output_path)
     
     print(f"\n✓ Complete!")
     print(f"  Downloaded: {len(downloaded_memories)} files")